@@ -0,0 +1,32 @@
+"""Numba-compiled numeric kernels shared by the preprocessing utilities.
+
+Signatures are declared explicitly so Numba compiles both dtype variants up
+front instead of re-specializing per call site, and cache=True persists the
+compiled artifacts on disk so repeated tuning runs skip the JIT warmup.
+(numba.pycc AOT compilation would remove even the first-run cost, but it is
+deprecated upstream; the on-disk cache covers the same use case.)
+"""
+import numpy as np
+
+try:
+    from numba import njit, float32, float64
+    HAVE_NUMBA = True
+except ImportError:
+    HAVE_NUMBA = False
+
+
+def _ema_py(x, alpha):
+    """ Single-pass recurrence: y[i] = alpha*x[i] + (1-alpha)*y[i-1]. """
+    y = np.empty_like(x)
+    y[0] = x[0]
+    for i in range(1, len(x)):
+        y[i] = alpha * x[i] + (1.0 - alpha) * y[i - 1]
+    return y
+
+
+if HAVE_NUMBA:
+    ema_kernel = njit(
+        [float32[:](float32[:], float64), float64[:](float64[:], float64)],
+        cache=True, fastmath=True)(_ema_py)
+else:
+    ema_kernel = _ema_py
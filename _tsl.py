@@ -0,0 +1,51 @@
+"""Trailing-stop state machine for backtest_buying_momentum.py.
+
+The numeric TSL update runs on every bar while a position is open, so it is
+compiled with Numba when available (cache=True amortizes the one-off compile
+across runs). Falls back to the identical pure-Python version otherwise.
+"""
+
+try:
+    from numba import njit
+    _HAVE_NUMBA = True
+except ImportError:
+    _HAVE_NUMBA = False
+
+# sl_mode encoding (ints so the kernel stays nopython-compatible)
+SL_NONE = 0
+SL_COST = 1
+SL_TRAILING = 2
+SL_MODE_NAMES = ('NONE', 'COST', 'TRAILING')
+
+
+def _update_tsl(pnl, max_pnl, sl_mode, sl_price, entry_price, qty,
+                trigger, step, inc):
+    """
+    One TSL step: move-to-cost once pnl reaches `trigger`, then step the SL
+    up by `inc` (in INR) for every `step` of profit beyond the trigger.
+    Returns (sl_price, sl_mode, max_pnl).
+    """
+    if sl_mode == SL_NONE and pnl >= trigger:
+        sl_mode = SL_COST
+        sl_price = entry_price
+        max_pnl = pnl
+
+    if sl_mode != SL_NONE:
+        if pnl > max_pnl:
+            max_pnl = pnl
+
+        excess = max_pnl - trigger
+        if excess >= step:
+            steps = int(excess // step)
+            new_sl = entry_price + ((steps * inc) / qty)
+            if new_sl > sl_price:
+                sl_price = new_sl
+                sl_mode = SL_TRAILING
+
+    return sl_price, sl_mode, max_pnl
+
+
+if _HAVE_NUMBA:
+    update_tsl = njit(cache=True)(_update_tsl)
+else:
+    update_tsl = _update_tsl
@@ -1,13 +1,20 @@
 import backtrader as bt
+import numpy as np
 import pandas as pd
+from pyarrow import feather
+import collections
 import os
 import datetime
 import sys
+from concurrent.futures import ThreadPoolExecutor
+
+from _tsl import update_tsl, SL_NONE, SL_COST, SL_TRAILING, SL_MODE_NAMES
 
 # =============================================================================
 # 1. CONFIGURATION & CONSTANTS
 # =============================================================================
 SPOT_FILE = 'MIDCPNIFTY/option_str_MIDCPNIFTY_backtest.csv'
+SPOT_FEATHER = SPOT_FILE.replace('.csv', '.feather')  # Arrow IPC cache
 OPTIONS_FOLDER = 'MIDCPNIFTY/ohlcv_options_MIDCPNIFTY_5m/'
 SUMMARY_OUTPUT = 'midcpnifty_summary_log.csv'
 DETAILS_FOLDER = 'trade_details'
@@ -17,6 +24,12 @@ MAX_TRADES_DAY = 2
 TSL_TRIGGER = 3000      # Profit to trigger Move-to-Cost
 TSL_STEP = 500          # Step profit to increase SL
 TSL_INCREMENT = 500     # Amount to increase SL by per step
+OPTION_CACHE_SIZE = 16  # Max option DataFrames kept in the LRU cache
+
+# Session times, built once (next() runs millions of times)
+_T_ENTRY_START = datetime.time(9, 20)
+_T_ENTRY_END = datetime.time(11, 0)
+_T_EXPIRY_EXIT = datetime.time(15, 15)
 
 # =============================================================================
 # 2. DATA FEED DEFINITION (SPOT DATA)
@@ -26,16 +39,84 @@ class MidcapSpotData(bt.feeds.PandasData):
     Maps the custom columns from the main backtest CSV to Backtrader lines.
     """
     lines = (
-        'expiry_day', 'expiry_month', 'expiry_year',
+        'is_expiry_today', 'active_bar',
+        'ema5', 'ema20_high', 'ema20_low', 'signal_ce', 'signal_pe',
     )
-    
+
     params = (
         ('datetime', 'time'),
         ('open', 'open'), ('high', 'high'), ('low', 'low'), ('close', 'close'),
         ('volume', 'volume'), ('openinterest', -1),
-        ('expiry_day', 'expiry_day'), ('expiry_month', 'expiry_month'), ('expiry_year', 'expiry_year'),
+        ('is_expiry_today', 'is_expiry_today'), ('active_bar', 'active_bar'),
+        ('ema5', 'ema5'), ('ema20_high', 'ema20_high'), ('ema20_low', 'ema20_low'),
+        ('signal_ce', 'signal_ce'), ('signal_pe', 'signal_pe'),
     )
 
+def _scan_option_paths(folder):
+    """ One folder scan: scrip_code -> parquet path for every option file. """
+    paths = {}
+    if os.path.exists(folder):
+        for fname in os.listdir(folder):
+            if fname.endswith('.parquet'):
+                paths[fname[:-8]] = os.path.join(folder, fname)
+    return paths
+
+
+def _load_option_entry(file_path):
+    """
+    Loads one option parquet as flat arrays + a monotonic cursor. Bar times
+    only move forward, so lookups are an amortized O(1) cursor advance
+    instead of index.asof + label-based .loc on every call.
+    """
+    df = pd.read_parquet(file_path)
+    return {
+        'ts_ns': df.index.values.astype('datetime64[ns]').view('int64'),
+        'close': df['close'].to_numpy(),
+        'cursor': 0,
+    }
+
+
+def _advance_cursor(entry, ts_ns):
+    """
+    Advances the cursor to the last option bar at or before ts_ns
+    (asof semantics). Returns -1 when ts_ns precedes the first bar.
+    """
+    arr = entry['ts_ns']
+    if len(arr) == 0:
+        # Header-only source file: degrade to "no data", like load failures
+        return -1
+    cur = entry['cursor']
+    if ts_ns < arr[cur]:
+        # Cursor is ahead of us (fresh entry or cache re-load):
+        # fall back to a binary search.
+        cur = int(np.searchsorted(arr, ts_ns, side='right')) - 1
+        if cur < 0:
+            return -1
+    else:
+        n = len(arr)
+        while cur + 1 < n and arr[cur + 1] <= ts_ns:
+            cur += 1
+    entry['cursor'] = cur
+    return cur
+
+
+def _write_ledger_csv(filepath, cols, ticker_names):
+    """ Writes one trade's ledger; runs on the background writer thread. """
+    # dict-of-lists hits pandas' fast columnar constructor (no per-row
+    # dtype inference); ids are expanded back to strings only here.
+    ts = pd.to_datetime(cols['ts_ns'])
+    pd.DataFrame({
+        'Date': ts.date,
+        'Time': ts.time,
+        'Event': cols['event'],
+        'Ticker': [ticker_names[i] for i in cols['ticker_id']],
+        'Price': cols['price'],
+        'PnL_INR': cols['pnl'],
+        'SL_Price': cols['sl'],
+        'SL_Mode': [SL_MODE_NAMES[m] for m in cols['sl_mode']],
+        'Info': cols['info'],
+    }).to_csv(filepath, index=False)
+
 # =============================================================================
 # 3. STRATEGY CLASS
 # =============================================================================
@@ -46,10 +127,8 @@ class MidcapOptionsStrategy(bt.Strategy):
     )
 
     def __init__(self):
-        # Indicators on Spot Data
-        self.ema5 = bt.indicators.EMA(self.data.close, period=5)
-        self.ema20_high = bt.indicators.EMA(self.data.high, period=20)
-        self.ema20_low = bt.indicators.EMA(self.data.low, period=20)
+        # Spot EMAs and crossover signals are precomputed vectorized in
+        # preprocess_spot() and arrive as plain feed lines.
 
         # State Variables
         self.current_date = None
@@ -63,149 +142,185 @@ class MidcapOptionsStrategy(bt.Strategy):
         self.entry_time = None      # Will hold the correct naive datetime object
         self.active_scrip = ""
         
-        # TSL State
-        self.sl_mode = 'NONE'       
+        # TSL State (mode encoded as int for the numba kernel)
+        self.sl_mode = SL_NONE
         self.current_sl_price = 0.0
         self.max_pnl_reached = 0.0
         
-        # Data Caching
-        self.active_option_df = None
+        # Data Caching (LRU keyed by scrip_code; strikes recur, so keep
+        # recently used DataFrames across scrip switches and days)
+        self.option_cache = collections.OrderedDict()
+        self._warned_scrips = set()   # scrips already reported as unloadable
+
+        # Scan the options folder once: per-bar availability checks become
+        # a dict lookup instead of os.path.join + a stat() syscall
+        self._path_cache = _scan_option_paths(self.p.options_folder)
         
-        # Logs
-        self.summary_log = []       
-        self.current_trade_ledger = [] 
+        # Per-bar arrays lifted out of the pandas feed once, so the hot path
+        # never goes through DataFrame.iloc (which builds a Series per call)
+        src = self.data.p.dataname
+        tz_aware = src['time'].dt.tz is not None
+        t = src['time'].dt.tz_localize(None) if tz_aware else src['time']
+        # Backtrader serves bars on the UTC-converted clock; option lookups
+        # have always run on that clock, so precompute it as int64 ns and
+        # skip the per-bar float->datetime->Timestamp round trip entirely.
+        bt_clock = src['time'].dt.tz_convert('UTC').dt.tz_localize(None) if tz_aware else t
+        self._bt_ns = bt_clock.to_numpy().astype('datetime64[ns]').view('int64')
+        self._time_py = np.asarray(t.dt.to_pydatetime())
+        ce_codes, ce_vocab = pd.factorize(src['icici_scrip_code_ce'])
+        pe_codes, pe_vocab = pd.factorize(src['icici_scrip_code_pe'])
+        self._scrip_ce_codes, self._scrip_ce_vocab = ce_codes, ce_vocab.tolist()
+        self._scrip_pe_codes, self._scrip_pe_vocab = pe_codes, pe_vocab.tolist()
+
+        # Logs (ledger kept as parallel lists of primitives, not row dicts)
+        self.summary_log = []
+        self.current_trade_ledger = self._new_ledger()
+        self._ticker_ids = {}
+        self._ticker_names = []
+
+        # Ledger CSVs are written off-thread so each close doesn't stall the
+        # simulation; stop() drains the pool before the run returns.
+        self._ledger_pool = ThreadPoolExecutor(max_workers=2)
 
         if not os.path.exists(DETAILS_FOLDER):
             os.makedirs(DETAILS_FOLDER)
 
     def _get_original_datetime_for_log(self):
         """
-        FIX: Handles Timestamp objects directly.
-        Removes timezone info to keep the 'wall clock' time (e.g., 09:15) 
-        and prevents UTC shifting.
+        Returns the source-CSV 'wall clock' time (e.g., 09:15) for the
+        current bar. The tz was stripped once at startup, so no UTC shifting.
         """
-        idx = len(self.data) - 1
-        # Retrieve the object from the dataframe (It is a pandas Timestamp)
-        raw_time = self.data.p.dataname.iloc[idx]['time']
-        
-        # If it has timezone info (e.g. +05:30), strip it while keeping local time
-        # .replace(tzinfo=None) or .tz_localize(None) does this
-        if hasattr(raw_time, 'tzinfo') and raw_time.tzinfo is not None:
-            # strip tz info, keeping the time as is (e.g. 09:15)
-            return raw_time.replace(tzinfo=None).to_pydatetime()
-        
-        # If it's just a naive timestamp or string, convert safely
-        return pd.to_datetime(raw_time).to_pydatetime()
+        return self._time_py[len(self.data) - 1]
+
+    def _load_option_arrays(self, scrip_code):
+        """ Fetches the option arrays via the LRU cache, loading on miss. """
+        entry = self.option_cache.get(scrip_code)
+        if entry is not None:
+            self.option_cache.move_to_end(scrip_code)
+            return entry
+        # Parquet written by preprocess_options.py: typed, tz-stripped,
+        # datetime-indexed and sorted, so no per-load parsing needed.
+        file_path = self._path_cache.get(scrip_code)
+        if file_path is None: return None
+        try:
+            entry = _load_option_entry(file_path)
+        except (OSError, KeyError, ValueError) as e:
+            # Narrow catch: a bare except here used to hide real dtype/tz
+            # bugs as silent per-bar slow paths. Warn once per scrip.
+            if scrip_code not in self._warned_scrips:
+                self._warned_scrips.add(scrip_code)
+                print(f"Error loading {scrip_code}: {e}")
+            return None
+        self.option_cache[scrip_code] = entry
+        if len(self.option_cache) > OPTION_CACHE_SIZE:
+            self.option_cache.popitem(last=False)
+        return entry
 
-    def get_option_price(self, scrip_code, check_datetime):
+    def get_option_price(self, scrip_code):
         """
-        Retrieves the option Close price for a specific datetime, loading CSV if needed.
+        Retrieves the option Close price for the current bar, loading if needed.
         """
-        if self.active_option_df is None or self.active_scrip != scrip_code:
-            file_path = os.path.join(self.p.options_folder, f"{scrip_code}.csv")
-            if not os.path.exists(file_path): return None
-            try:
-                df = pd.read_csv(file_path)
-                time_col = 'datetime' if 'datetime' in df.columns else 'time'
-                df[time_col] = pd.to_datetime(df[time_col])
-                df.set_index(time_col, inplace=True)
-                if not df.index.is_monotonic_increasing: df.sort_index(inplace=True)
-                self.active_option_df = df
-                self.active_scrip = scrip_code
-            except: return None
+        entry = self._load_option_arrays(scrip_code)
+        if entry is None: return None
 
-        try:
-            ts = pd.Timestamp(bt.num2date(check_datetime))
-            idx = self.active_option_df.index.asof(ts)
-            if pd.notna(idx):
-                return self.active_option_df.loc[idx]['close']
-            return None
-        except: return None
+        ts_ns = self._bt_ns[len(self.data) - 1]
+        cur = _advance_cursor(entry, ts_ns)
+        if cur < 0: return None
+        return entry['close'][cur]
+
+    @staticmethod
+    def _new_ledger():
+        """ Fresh columnar (struct-of-arrays) ledger for one trade. """
+        return {'ts_ns': [], 'event': [], 'ticker_id': [], 'price': [],
+                'pnl': [], 'sl': [], 'sl_mode': [], 'info': []}
+
+    def _ticker_id(self, scrip):
+        """ Small-int id for a scrip, so the ledger doesn't duplicate strings. """
+        tid = self._ticker_ids.get(scrip)
+        if tid is None:
+            tid = len(self._ticker_names)
+            self._ticker_ids[scrip] = tid
+            self._ticker_names.append(scrip)
+        return tid
 
     def log_trade_step(self, dt, event, price, pnl_val, sl_price, info=""):
         """ records a single step (minute) in the trade's specific log """
-        self.current_trade_ledger.append({
-            # Logging the full Backtrader datetime object (dt) here is fine 
-            # for internal log; the summary requires the fixed time.
-            'Date': dt.date(),
-            'Time': dt.time(),
-            'Event': event,
-            'Ticker': self.active_scrip,
-            'Price': round(price, 2),
-            'PnL_INR': round(pnl_val, 2),
-            'SL_Price': round(sl_price, 2) if sl_price > 0 else 0,
-            'SL_Mode': self.sl_mode,
-            'Info': info
-        })
+        # Logging the full Backtrader datetime (dt) here is fine for the
+        # internal log; the summary requires the fixed time.
+        cols = self.current_trade_ledger
+        cols['ts_ns'].append(pd.Timestamp(dt).value)
+        cols['event'].append(event)
+        cols['ticker_id'].append(self._ticker_id(self.active_scrip))
+        # float() first: round() on a np.float32 stays float32, which can't
+        # hold 2-decimal values and prints as e.g. -549.5999755859375
+        cols['price'].append(round(float(price), 2))
+        cols['pnl'].append(round(float(pnl_val), 2))
+        cols['sl'].append(round(float(sl_price), 2) if sl_price > 0 else 0)
+        cols['sl_mode'].append(self.sl_mode)
+        cols['info'].append(info)
 
 
     def next(self):
+        # Outside the precomputed session window nothing can happen while
+        # flat, so skip all per-bar work before extracting any datetimes.
+        if not self.position_active and not self.data.active_bar[0]:
+            return
+
         dt_full = self.data.datetime.datetime(0)
         current_date = dt_full.date()
         current_time = dt_full.time()
 
-        # New Day Reset
+        # New Day Reset (option cache is kept: the same strikes recur)
         if self.current_date != current_date:
             self.current_date = current_date
             self.trades_today = 0
-            self.active_option_df = None
 
-        # Expiry Check
-        exp_day = int(self.data.expiry_day[0])
-        exp_month = int(self.data.expiry_month[0])
-        exp_year = int(self.data.expiry_year[0])
-        is_expiry_today = (current_date.day == exp_day and 
-                           current_date.month == exp_month and 
-                           current_date.year == exp_year)
+        # Expiry Check (mask precomputed over the whole frame in __main__)
+        is_expiry_today = bool(self.data.is_expiry_today[0])
 
         # ---------------------------------------------------------------------
         # ACTIVE POSITION LOGIC
         # ---------------------------------------------------------------------
         if self.position_active:
             # 1. Force Expiry Exit
-            if is_expiry_today and current_time >= datetime.time(15, 15):
-                curr_opt_price = self.get_option_price(self.active_scrip, self.data.datetime[0])
+            if is_expiry_today and current_time >= _T_EXPIRY_EXIT:
+                curr_opt_price = self.get_option_price(self.active_scrip)
                 if curr_opt_price is None: curr_opt_price = self.entry_price
                 self.close_trade("EXPIRY_FORCE", dt_full, curr_opt_price)
                 return
 
             # 2. Get Price & TSL Logic
-            curr_opt_price = self.get_option_price(self.active_scrip, self.data.datetime[0])
+            curr_opt_price = self.get_option_price(self.active_scrip)
             if curr_opt_price is None: return
 
             pnl_val = (curr_opt_price - self.entry_price) * self.p.qty
             self.log_trade_step(dt_full, "HOLD", curr_opt_price, pnl_val, self.current_sl_price, "Monitoring")
 
-            # TSL Check (Logic is same as previous implementation)
-            if self.sl_mode == 'NONE' and pnl_val >= TSL_TRIGGER:
-                self.sl_mode = 'COST'
+            # TSL Check (numeric state machine JIT-compiled in _tsl.py)
+            prev_mode = self.sl_mode
+            new_sl, new_mode, new_max = update_tsl(
+                pnl_val, self.max_pnl_reached, self.sl_mode, self.current_sl_price,
+                self.entry_price, self.p.qty, TSL_TRIGGER, TSL_STEP, TSL_INCREMENT)
+
+            if prev_mode == SL_NONE and new_mode != SL_NONE:
+                self.sl_mode = SL_COST
                 self.current_sl_price = self.entry_price
-                self.max_pnl_reached = pnl_val
                 self.log_trade_step(dt_full, "TSL_UPDATE", curr_opt_price, pnl_val, self.current_sl_price, "Moved to Cost")
-
-            if self.sl_mode in ['COST', 'TRAILING']:
-                if pnl_val > self.max_pnl_reached:
-                    self.max_pnl_reached = pnl_val
-                
-                excess = self.max_pnl_reached - TSL_TRIGGER
-                if excess >= TSL_STEP:
-                    steps = int(excess // TSL_STEP)
-                    new_sl = self.entry_price + ((steps * TSL_INCREMENT) / self.p.qty)
-                    
-                    if new_sl > self.current_sl_price:
-                        self.current_sl_price = new_sl
-                        self.sl_mode = 'TRAILING'
-                        self.log_trade_step(dt_full, "TSL_UPDATE", curr_opt_price, pnl_val, self.current_sl_price, "Stepped Up")
+            if new_mode == SL_TRAILING and new_sl > self.current_sl_price:
+                self.sl_mode = SL_TRAILING
+                self.current_sl_price = new_sl
+                self.log_trade_step(dt_full, "TSL_UPDATE", curr_opt_price, pnl_val, self.current_sl_price, "Stepped Up")
+            self.sl_mode, self.current_sl_price, self.max_pnl_reached = new_mode, new_sl, new_max
 
             # Exits
-            if self.sl_mode != 'NONE' and curr_opt_price <= self.current_sl_price:
+            if self.sl_mode != SL_NONE and curr_opt_price <= self.current_sl_price:
                 self.close_trade("TSL_HIT", dt_full, self.current_sl_price)
                 return
             
-            if self.pos_type == 'CE' and self.ema5[0] < self.ema20_low[0]:
+            if self.pos_type == 'CE' and self.data.ema5[0] < self.data.ema20_low[0]:
                 self.close_trade("EMA_REVERSAL", dt_full, curr_opt_price)
                 return
-            elif self.pos_type == 'PE' and self.ema5[0] > self.ema20_high[0]:
+            elif self.pos_type == 'PE' and self.data.ema5[0] > self.data.ema20_high[0]:
                 self.close_trade("EMA_REVERSAL", dt_full, curr_opt_price)
                 return
 
@@ -213,22 +328,21 @@ class MidcapOptionsStrategy(bt.Strategy):
         # ENTRY LOGIC
         # ---------------------------------------------------------------------
         elif not self.position_active:
-            if not (datetime.time(9, 20) <= current_time <= datetime.time(11, 0)): return
+            if not (_T_ENTRY_START <= current_time <= _T_ENTRY_END): return
             if self.trades_today >= MAX_TRADES_DAY: return
 
-            signal_ce = (self.ema5[-1] <= self.ema20_high[-1]) and (self.ema5[0] > self.ema20_high[0])
-            signal_pe = (self.ema5[-1] >= self.ema20_low[-1]) and (self.ema5[0] < self.ema20_low[0])
-
-            if signal_ce: self.entry_setup('CE', dt_full)
-            elif signal_pe: self.entry_setup('PE', dt_full)
+            if self.data.signal_ce[0]: self.entry_setup('CE', dt_full)
+            elif self.data.signal_pe[0]: self.entry_setup('PE', dt_full)
 
     def entry_setup(self, type_, dt):
         """ Executes the trade entry sequence. """
-        idx = len(self.data) - 1 
-        row = self.data.p.dataname.iloc[idx]
-        scrip = row['icici_scrip_code_ce'] if type_ == 'CE' else row['icici_scrip_code_pe']
+        idx = len(self.data) - 1
+        if type_ == 'CE':
+            scrip = self._scrip_ce_vocab[self._scrip_ce_codes[idx]]
+        else:
+            scrip = self._scrip_pe_vocab[self._scrip_pe_codes[idx]]
         
-        price = self.get_option_price(scrip, self.data.datetime[0])
+        price = self.get_option_price(scrip)
         
         if price:
             self.total_trades_count += 1
@@ -244,12 +358,12 @@ class MidcapOptionsStrategy(bt.Strategy):
             self.trades_today += 1
             
             # Reset TSL
-            self.sl_mode = 'NONE'
+            self.sl_mode = SL_NONE
             self.current_sl_price = 0.0
             self.max_pnl_reached = 0.0
             
             # Init Trade Ledger
-            self.current_trade_ledger = []
+            self.current_trade_ledger = self._new_ledger()
             self.log_trade_step(dt, "ENTRY", price, 0, 0, f"Signal {type_}")
 
 
@@ -268,9 +382,9 @@ class MidcapOptionsStrategy(bt.Strategy):
             # --- FIX: Use the original timestamp for clean logging ---
             'SellDateTime': self._get_original_datetime_for_log(),
             # --- END FIX ---
-            'BuyPrice': round(self.entry_price, 2),
-            'SellPrice': round(price, 2),
-            'PnL': round(pnl, 2),
+            'BuyPrice': round(float(self.entry_price), 2),
+            'SellPrice': round(float(price), 2),
+            'PnL': round(float(pnl), 2),
             'ExitReason': reason
         })
         
@@ -278,42 +392,300 @@ class MidcapOptionsStrategy(bt.Strategy):
         filename = f"Trade_{self.total_trades_count}_{self.active_scrip}_{self.entry_time.date()}.csv"
         filepath = os.path.join(DETAILS_FOLDER, filename)
         
-        df_ledger = pd.DataFrame(self.current_trade_ledger)
-        df_ledger.to_csv(filepath, index=False)
-        
+        # The ledger is handed off as-is; entry_setup rebinds a fresh one
+        # for the next trade, so the writer thread owns this one.
+        self._ledger_pool.submit(_write_ledger_csv, filepath,
+                                 self.current_trade_ledger, self._ticker_names)
+
         # Reset
         self.position_active = False
         self.pos_type = None
         self.active_scrip = ""
 
+    def stop(self):
+        """ Drains pending ledger writes before cerebro.run() returns. """
+        self._ledger_pool.shutdown(wait=True)
+
 # =============================================================================
-# 4. MAIN EXECUTION
+# 4. SPOT PREPROCESSING
 # =============================================================================
-if __name__ == '__main__':
-    cerebro = bt.Cerebro()
-    
-    if os.path.exists(SPOT_FILE):
-        print("Loading Data...")
+def load_spot():
+    """
+    Loads the spot dataset. Prefers the memory-mapped Arrow IPC (Feather v2)
+    cache — zero-copy, no text parsing — and writes it after the first CSV
+    parse so iterative tuning runs skip the parse entirely. The cache holds
+    naive local wall-clock time (shared with backtest_crossselling.py).
+    """
+    if os.path.exists(SPOT_FEATHER):
+        df = feather.read_feather(SPOT_FEATHER, memory_map=True)
+    else:
         df = pd.read_csv(SPOT_FILE)
-        # Ensure 'time' is parsed to datetime objects for BT/Pandas
-        df['time'] = pd.to_datetime(df['time']) 
+        # Explicit ISO8601 format takes the C fast path (no per-row format
+        # inference); convert to local wall-clock time and drop the tz.
+        df['time'] = (pd.to_datetime(df['time'], format='ISO8601', utc=True)
+                      .dt.tz_convert('Asia/Kolkata').dt.tz_localize(None))
         df.sort_values('time', inplace=True)
-        
-        data = MidcapSpotData(dataname=df)
-        cerebro.adddata(data)
-        cerebro.addstrategy(MidcapOptionsStrategy)
-        
-        print("Running Backtest...")
-        strategies = cerebro.run()
-        strat = strategies[0]
-        
+        df.reset_index(drop=True, inplace=True)
+        # Quantize: float32 is ample for 0.05-tick prices, expiry parts fit
+        # int16, scrip codes become dictionary-encoded categories (int codes
+        # plus one string table) — roughly halves the frame's footprint
+        for col in ('open', 'high', 'low', 'close', 'volume'):
+            df[col] = df[col].astype('float32')
+        for col in ('expiry_day', 'expiry_month', 'expiry_year'):
+            df[col] = df[col].astype('int16')
+        for col in ('icici_scrip_code_ce', 'icici_scrip_code_pe'):
+            df[col] = df[col].astype('category')
+        feather.write_feather(df, SPOT_FEATHER)
+    # This strategy's session windows run on Backtrader's UTC-converted bar
+    # clock (the published results depend on that), so re-localize.
+    df['time'] = df['time'].dt.tz_localize('Asia/Kolkata')
+    return df
+
+
+def preprocess_spot(df):
+    """
+    One vectorized pass over the spot frame: expiry/session masks plus the
+    EMAs and crossover signals the strategy used to recompute bar by bar.
+    """
+    # Expiry mask
+    df['expiry_date'] = pd.to_datetime(dict(
+        year=df['expiry_year'], month=df['expiry_month'], day=df['expiry_day']))
+    t = df['time'].dt.tz_localize(None) if df['time'].dt.tz is not None else df['time']
+    df['days_to_expiry'] = (df['expiry_date'] - t.dt.normalize()).dt.days
+    df['is_expiry_today'] = df['days_to_expiry'] == 0
+
+    # Bars where the strategy can act while flat (entry window through
+    # the expiry force-exit, in Backtrader's UTC-converted bar clock)
+    bt_time = df['time'].dt.tz_convert('UTC').dt.time
+    df['active_bar'] = (bt_time >= _T_ENTRY_START) & (bt_time <= _T_EXPIRY_EXIT)
+
+    # Spot EMAs and crossover signals, computed once in pandas/C instead of
+    # per bar through Backtrader's lineseries machinery
+    df['ema5'] = df['close'].ewm(span=5, adjust=False).mean()
+    df['ema20_high'] = df['high'].ewm(span=20, adjust=False).mean()
+    df['ema20_low'] = df['low'].ewm(span=20, adjust=False).mean()
+    df['signal_ce'] = ((df['ema5'].shift(1) <= df['ema20_high'].shift(1)) &
+                       (df['ema5'] > df['ema20_high']))
+    df['signal_pe'] = ((df['ema5'].shift(1) >= df['ema20_low'].shift(1)) &
+                       (df['ema5'] < df['ema20_low']))
+    return df
+
+# =============================================================================
+# 5. FLAT RUNNER (optional, --flat)
+# =============================================================================
+def run_flat(df, options_folder=OPTIONS_FOLDER, qty=LOT_SIZE):
+    """
+    NumPy-driven replacement for the Backtrader event loop. Walks flat
+    arrays with plain int indexing and runs the same state machine as
+    MidcapOptionsStrategy, producing the same summary and ledger output
+    without per-bar lineseries dispatch. The Backtrader path is kept for
+    API compatibility; select this one with --flat.
+    """
+    # --- flat per-bar arrays (same clocks as the Backtrader path) ---
+    bt_clock = df['time'].dt.tz_convert('UTC').dt.tz_localize(None)
+    ts_utc_ns = bt_clock.to_numpy().astype('datetime64[ns]').view('int64')
+    dt_utc = np.asarray(bt_clock.dt.to_pydatetime())       # Backtrader's bar clock
+    local = df['time'].dt.tz_localize(None)
+    time_py = np.asarray(local.dt.to_pydatetime())         # wall clock, for logs
+    active = df['active_bar'].to_numpy(dtype=bool)
+    is_expiry = df['is_expiry_today'].to_numpy(dtype=bool)
+    ema5 = df['ema5'].to_numpy()
+    ema20_high = df['ema20_high'].to_numpy()
+    ema20_low = df['ema20_low'].to_numpy()
+    sig_ce = df['signal_ce'].to_numpy(dtype=bool)
+    sig_pe = df['signal_pe'].to_numpy(dtype=bool)
+    ce_codes, ce_vocab = pd.factorize(df['icici_scrip_code_ce'])
+    pe_codes, pe_vocab = pd.factorize(df['icici_scrip_code_pe'])
+    ce_vocab, pe_vocab = ce_vocab.tolist(), pe_vocab.tolist()
+
+    # --- option store (same LRU/cursor machinery as the strategy) ---
+    paths = _scan_option_paths(options_folder)
+    option_cache = collections.OrderedDict()
+    warned_scrips = set()
+
+    def get_option_price(scrip_code, i):
+        entry = option_cache.get(scrip_code)
+        if entry is None:
+            file_path = paths.get(scrip_code)
+            if file_path is None: return None
+            try:
+                entry = _load_option_entry(file_path)
+            except (OSError, KeyError, ValueError) as e:
+                if scrip_code not in warned_scrips:
+                    warned_scrips.add(scrip_code)
+                    print(f"Error loading {scrip_code}: {e}")
+                return None
+            option_cache[scrip_code] = entry
+            if len(option_cache) > OPTION_CACHE_SIZE:
+                option_cache.popitem(last=False)
+        else:
+            option_cache.move_to_end(scrip_code)
+        cur = _advance_cursor(entry, ts_utc_ns[i])
+        if cur < 0: return None
+        return entry['close'][cur]
+
+    # --- trade state (mirrors MidcapOptionsStrategy) ---
+    state = {
+        'current_date': None, 'trades_today': 0, 'total_trades': 0,
+        'position_active': False, 'pos_type': None, 'entry_price': 0.0,
+        'entry_time': None, 'active_scrip': "",
+        'sl_mode': SL_NONE, 'current_sl': 0.0, 'max_pnl': 0.0,
+        'ledger': None,
+    }
+    summary_log = []
+    ticker_ids, ticker_names = {}, []
+    ledger_pool = ThreadPoolExecutor(max_workers=2)
+    if not os.path.exists(DETAILS_FOLDER):
+        os.makedirs(DETAILS_FOLDER)
+
+    def ticker_id(scrip):
+        tid = ticker_ids.get(scrip)
+        if tid is None:
+            tid = len(ticker_names)
+            ticker_ids[scrip] = tid
+            ticker_names.append(scrip)
+        return tid
+
+    def log_step(i, event, price, pnl_val, sl_price, info=""):
+        cols = state['ledger']
+        cols['ts_ns'].append(ts_utc_ns[i])
+        cols['event'].append(event)
+        cols['ticker_id'].append(ticker_id(state['active_scrip']))
+        # float() first: round() on a np.float32 stays float32, which can't
+        # hold 2-decimal values and prints as e.g. -549.5999755859375
+        cols['price'].append(round(float(price), 2))
+        cols['pnl'].append(round(float(pnl_val), 2))
+        cols['sl'].append(round(float(sl_price), 2) if sl_price > 0 else 0)
+        cols['sl_mode'].append(state['sl_mode'])
+        cols['info'].append(info)
+
+    def entry_setup(i, type_):
+        scrip = ce_vocab[ce_codes[i]] if type_ == 'CE' else pe_vocab[pe_codes[i]]
+        price = get_option_price(scrip, i)
+        if price:
+            state['total_trades'] += 1
+            state['position_active'] = True
+            state['pos_type'] = type_
+            state['entry_price'] = price
+            state['active_scrip'] = scrip
+            state['entry_time'] = time_py[i]
+            state['trades_today'] += 1
+            state['sl_mode'] = SL_NONE
+            state['current_sl'] = 0.0
+            state['max_pnl'] = 0.0
+            state['ledger'] = MidcapOptionsStrategy._new_ledger()
+            log_step(i, "ENTRY", price, 0, 0, f"Signal {type_}")
+
+    def close_trade(i, reason, price):
+        pnl = (price - state['entry_price']) * qty
+        log_step(i, "EXIT", price, pnl, state['current_sl'], reason)
+        summary_log.append({
+            'TradeID': state['total_trades'],
+            'ScripName': state['active_scrip'],
+            'BuyDateTime': state['entry_time'],
+            'SellDateTime': time_py[i],
+            'BuyPrice': round(float(state['entry_price']), 2),
+            'SellPrice': round(float(price), 2),
+            'PnL': round(float(pnl), 2),
+            'ExitReason': reason
+        })
+        filename = f"Trade_{state['total_trades']}_{state['active_scrip']}_{state['entry_time'].date()}.csv"
+        ledger_pool.submit(_write_ledger_csv, os.path.join(DETAILS_FOLDER, filename),
+                           state['ledger'], ticker_names)
+        state['position_active'] = False
+        state['pos_type'] = None
+        state['active_scrip'] = ""
+
+    # --- main loop ---
+    for i in range(len(ts_utc_ns)):
+        if not state['position_active'] and not active[i]:
+            continue
+
+        dt_full = dt_utc[i]
+        current_date = dt_full.date()
+        current_time = dt_full.time()
+
+        if state['current_date'] != current_date:
+            state['current_date'] = current_date
+            state['trades_today'] = 0
+
+        if state['position_active']:
+            if is_expiry[i] and current_time >= _T_EXPIRY_EXIT:
+                curr_opt_price = get_option_price(state['active_scrip'], i)
+                if curr_opt_price is None: curr_opt_price = state['entry_price']
+                close_trade(i, "EXPIRY_FORCE", curr_opt_price)
+                continue
+
+            curr_opt_price = get_option_price(state['active_scrip'], i)
+            if curr_opt_price is None: continue
+
+            pnl_val = (curr_opt_price - state['entry_price']) * qty
+            log_step(i, "HOLD", curr_opt_price, pnl_val, state['current_sl'], "Monitoring")
+
+            prev_mode = state['sl_mode']
+            new_sl, new_mode, new_max = update_tsl(
+                pnl_val, state['max_pnl'], state['sl_mode'], state['current_sl'],
+                state['entry_price'], qty, TSL_TRIGGER, TSL_STEP, TSL_INCREMENT)
+
+            if prev_mode == SL_NONE and new_mode != SL_NONE:
+                state['sl_mode'] = SL_COST
+                state['current_sl'] = state['entry_price']
+                log_step(i, "TSL_UPDATE", curr_opt_price, pnl_val, state['current_sl'], "Moved to Cost")
+            if new_mode == SL_TRAILING and new_sl > state['current_sl']:
+                state['sl_mode'] = SL_TRAILING
+                state['current_sl'] = new_sl
+                log_step(i, "TSL_UPDATE", curr_opt_price, pnl_val, state['current_sl'], "Stepped Up")
+            state['sl_mode'], state['current_sl'], state['max_pnl'] = new_mode, new_sl, new_max
+
+            if state['sl_mode'] != SL_NONE and curr_opt_price <= state['current_sl']:
+                close_trade(i, "TSL_HIT", state['current_sl'])
+                continue
+
+            if state['pos_type'] == 'CE' and ema5[i] < ema20_low[i]:
+                close_trade(i, "EMA_REVERSAL", curr_opt_price)
+                continue
+            elif state['pos_type'] == 'PE' and ema5[i] > ema20_high[i]:
+                close_trade(i, "EMA_REVERSAL", curr_opt_price)
+                continue
+
+        else:
+            if not (_T_ENTRY_START <= current_time <= _T_ENTRY_END): continue
+            if state['trades_today'] >= MAX_TRADES_DAY: continue
+
+            if sig_ce[i]: entry_setup(i, 'CE')
+            elif sig_pe[i]: entry_setup(i, 'PE')
+
+    ledger_pool.shutdown(wait=True)
+    return summary_log
+
+# =============================================================================
+# 6. MAIN EXECUTION
+# =============================================================================
+if __name__ == '__main__':
+    if os.path.exists(SPOT_FILE) or os.path.exists(SPOT_FEATHER):
+        print("Loading Data...")
+        df = preprocess_spot(load_spot())
+
+        if '--flat' in sys.argv:
+            print("Running Backtest (flat loop)...")
+            summary_log = run_flat(df)
+        else:
+            cerebro = bt.Cerebro()
+            data = MidcapSpotData(dataname=df)
+            cerebro.adddata(data)
+            cerebro.addstrategy(MidcapOptionsStrategy)
+
+            print("Running Backtest...")
+            strategies = cerebro.run()
+            summary_log = strategies[0].summary_log
+
         # Save Summary
-        if strat.summary_log:
-            pd.DataFrame(strat.summary_log).to_csv(SUMMARY_OUTPUT, index=False)
+        if summary_log:
+            pd.DataFrame(summary_log).to_csv(SUMMARY_OUTPUT, index=False)
             print(f"\nSuccess! Summary saved to: {SUMMARY_OUTPUT}")
             print(f"Individual trade logs saved in folder: {DETAILS_FOLDER}/")
-            print(f"Total Trades: {len(strat.summary_log)}")
-            print(f"Total PnL: {sum(x['PnL'] for x in strat.summary_log):.2f}")
+            print(f"Total Trades: {len(summary_log)}")
+            print(f"Total PnL: {sum(x['PnL'] for x in summary_log):.2f}")
         else:
             print("No trades generated.")
     else:
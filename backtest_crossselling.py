@@ -1,14 +1,19 @@
 import backtrader as bt
+import numpy as np
 import pandas as pd
+from pyarrow import feather
+import collections
 import os
 import datetime
 import sys
+from concurrent.futures import ThreadPoolExecutor
 
 # =============================================================================
 # 1. CONFIGURATION
 # =============================================================================
 # Ensure these paths match your folder structure exactly
 SPOT_FILE = 'MIDCPNIFTY/option_str_MIDCPNIFTY_backtest.csv'
+SPOT_FEATHER = SPOT_FILE.replace('.csv', '.feather')  # Arrow IPC cache
 # Using the preprocessed/sorted folder you mentioned
 OPTIONS_FOLDER = 'MIDCPNIFTY/preprocessed_ohlcv_options_MIDCPNIFTY_5m/' 
 SUMMARY_OUTPUT = 'midcpnifty_selling_summary_log.csv'
@@ -20,25 +25,44 @@ EMA_FAST = 19
 EMA_SLOW = 50
 TARGET_LTP = 30         # Exit if price drops below this (Take Profit)
 ROLLOVER_DAYS = 4       # Stop trading/Exit this many days before expiry
+OPTION_CACHE_SIZE = 16  # Max option DataFrames kept in the LRU cache
+_STALE_NS = 900 * 1_000_000_000  # 15-min option-data staleness gate, in ns
 
-# Entry Window (Local Indian Time)
+# Entry Window (Local Indian Time), built once (next() runs per bar)
 ENTRY_START_HOUR = 14
 ENTRY_START_MIN = 0
 ENTRY_END_HOUR = 15
 ENTRY_END_MIN = 30
+_T_ENTRY_START = datetime.time(ENTRY_START_HOUR, ENTRY_START_MIN)
+_T_ENTRY_END = datetime.time(ENTRY_END_HOUR, ENTRY_END_MIN)
 
 # =============================================================================
 # 2. DATA FEED
 # =============================================================================
 class MidcapSpotData(bt.feeds.PandasData):
-    lines = ('expiry_day', 'expiry_month', 'expiry_year',)
+    lines = ('is_rollover', 'active_bar',)
     params = (
         ('datetime', 'time'),
         ('open', 'open'), ('high', 'high'), ('low', 'low'), ('close', 'close'),
         ('volume', 'volume'), ('openinterest', -1),
-        ('expiry_day', 'expiry_day'), ('expiry_month', 'expiry_month'), ('expiry_year', 'expiry_year'),
+        ('is_rollover', 'is_rollover'), ('active_bar', 'active_bar'),
     )
 
+def _write_ledger_csv(filepath, cols, ticker_names):
+    """ Writes one trade's ledger; runs on the background writer thread. """
+    # dict-of-lists hits pandas' fast columnar constructor (no per-row
+    # dtype inference); ids are expanded back to strings only here.
+    ts = pd.to_datetime(cols['ts_ns'])
+    pd.DataFrame({
+        'Date': ts.date,
+        'Time': ts.time,
+        'Event': cols['event'],
+        'Ticker': [ticker_names[i] for i in cols['ticker_id']],
+        'Price': cols['price'],
+        'PnL_INR': cols['pnl'],
+        'Info': cols['info'],
+    }).to_csv(filepath, index=False)
+
 # =============================================================================
 # 3. STRATEGY CLASS
 # =============================================================================
@@ -50,6 +74,7 @@ class OptionSellingStrategy(bt.Strategy):
 
     def __init__(self):
         # State
+        self.current_date = None
         self.total_trades_count = 0
         self.position_active = False
         self.pos_type = None  # 'CE' or 'PE'
@@ -57,13 +82,40 @@ class OptionSellingStrategy(bt.Strategy):
         self.active_scrip = ""
         self.entry_time = None
         
-        # Caching
-        self.active_option_df = None  
+        # Caching (LRU keyed by scrip_code; serves both the PE and CE checks
+        # in the entry window and re-entries into recurring strikes)
+        self.option_cache = collections.OrderedDict()
+        self._warned_scrips = set()   # scrips already reported as unloadable
+
+        # Scan the options folder once: per-bar availability checks become
+        # a dict lookup instead of os.path.join + a stat() syscall
+        self._path_cache = {}
+        if os.path.exists(self.p.options_folder):
+            for fname in os.listdir(self.p.options_folder):
+                if fname.endswith('.parquet'):
+                    self._path_cache[fname[:-8]] = os.path.join(self.p.options_folder, fname)
         
-        # Logs
+        # Per-bar arrays lifted out of the pandas feed once, so the hot path
+        # never goes through DataFrame.iloc (which builds a Series per call)
+        src = self.data.p.dataname
+        t = src['time'].dt.tz_localize(None) if src['time'].dt.tz is not None else src['time']
+        self._time_ns = t.to_numpy().astype('datetime64[ns]').view('int64')
+        self._time_py = np.asarray(t.dt.to_pydatetime())
+        ce_codes, ce_vocab = pd.factorize(src['icici_scrip_code_ce'])
+        pe_codes, pe_vocab = pd.factorize(src['icici_scrip_code_pe'])
+        self._scrip_ce_codes, self._scrip_ce_vocab = ce_codes, ce_vocab.tolist()
+        self._scrip_pe_codes, self._scrip_pe_vocab = pe_codes, pe_vocab.tolist()
+
+        # Logs (ledger kept as parallel lists of primitives, not row dicts)
         self.summary_log = []
-        self.current_trade_ledger = []
-        
+        self.current_trade_ledger = self._new_ledger()
+        self._ticker_ids = {}
+        self._ticker_names = []
+
+        # Ledger CSVs are written off-thread so each close doesn't stall the
+        # simulation; stop() drains the pool before the run returns.
+        self._ledger_pool = ThreadPoolExecutor(max_workers=2)
+
         if not os.path.exists(DETAILS_FOLDER):
             os.makedirs(DETAILS_FOLDER)
 
@@ -72,121 +124,166 @@ class OptionSellingStrategy(bt.Strategy):
     # -------------------------------------------------------------------------
     def _get_current_local_time(self):
         """
-        Retrieves the exact timestamp from the source CSV row, bypassing 
-        Backtrader's internal timezone conversion.
-        Returns a naive datetime object (e.g., 2024-01-01 14:15:00).
+        Retrieves the exact timestamp of the current bar, bypassing
+        Backtrader's internal timezone conversion. The tz was stripped once
+        at startup, so this is a naive datetime (e.g., 2024-01-01 14:15:00).
         """
-        idx = len(self.data) - 1
-        # Access the raw object from the dataframe
-        raw_time = self.data.p.dataname.iloc[idx]['time']
-        
-        # If it's a pandas Timestamp with timezone, strip it
-        if hasattr(raw_time, 'tzinfo'):
-            if raw_time.tzinfo is not None:
-                return raw_time.replace(tzinfo=None).to_pydatetime()
-            return raw_time.to_pydatetime()
-        
-        # If string
-        if isinstance(raw_time, str):
-            return pd.to_datetime(raw_time.split('+')[0]).to_pydatetime()
-            
-        return raw_time
+        return self._time_py[len(self.data) - 1]
 
     # -------------------------------------------------------------------------
     # HELPER: Dynamic Indicator Calculation
     # -------------------------------------------------------------------------
-    def get_option_indicators(self, scrip_code, local_dt):
+    def _load_option_arrays(self, scrip_code):
+        """ Fetches the option arrays via the LRU cache, loading on miss. """
+        entry = self.option_cache.get(scrip_code)
+        if entry is not None:
+            self.option_cache.move_to_end(scrip_code)
+            return entry
+        # Parquet written by preprocess_options.py: tz-stripped, indexed,
+        # sorted and with EMA19/EMA50 columns already computed, so the
+        # per-load to_datetime/ewm work is all done up front.
+        file_path = self._path_cache.get(scrip_code)
+        if file_path is None:
+            # print(f"File not found: {scrip_code}")
+            return None
+        try:
+            df = pd.read_parquet(file_path)
+            # Flat arrays + a monotonic cursor: bar times only move forward,
+            # so the per-bar lookup is an amortized O(1) advance instead of
+            # index.asof + label-based .loc on every call.
+            entry = {
+                'ts_ns': df.index.values.astype('datetime64[ns]').view('int64'),
+                'close': df['close'].to_numpy(),
+                'ema19': df['EMA19_Close'].to_numpy(),
+                'ema50_high': df['EMA50_High'].to_numpy(),
+                'ema50_low': df['EMA50_Low'].to_numpy(),
+                'cursor': 0,
+            }
+        except (OSError, KeyError, ValueError) as e:
+            # Narrow catch (a bare except would swallow KeyboardInterrupt
+            # and hide real dtype/tz bugs). Warn once per scrip.
+            if scrip_code not in self._warned_scrips:
+                self._warned_scrips.add(scrip_code)
+                print(f"Error loading {scrip_code}: {e}")
+            return None
+        self.option_cache[scrip_code] = entry
+        if len(self.option_cache) > OPTION_CACHE_SIZE:
+            self.option_cache.popitem(last=False)
+        return entry
+
+    @staticmethod
+    def _locate(entry, ts_ns):
         """
-        Loads option CSV, calculates indicators, and finds the row matching local_dt.
+        Advances the cursor to the last option bar at or before ts_ns
+        (asof semantics). Returns -1 when ts_ns precedes the first bar.
         """
-        # 1. Load Data (Cache if it's the active scrip)
-        df = None
-        if self.position_active and scrip_code == self.active_scrip and self.active_option_df is not None:
-            df = self.active_option_df
+        arr = entry['ts_ns']
+        if len(arr) == 0:
+            # Header-only source file: degrade to "no data", like load failures
+            return -1
+        cur = entry['cursor']
+        if ts_ns < arr[cur]:
+            # Cursor is ahead of us (fresh entry or cache re-load):
+            # fall back to a binary search.
+            cur = int(np.searchsorted(arr, ts_ns, side='right')) - 1
+            if cur < 0:
+                return -1
         else:
-            file_path = os.path.join(self.p.options_folder, f"{scrip_code}.csv")
-            if not os.path.exists(file_path): 
-                # print(f"File not found: {scrip_code}") 
-                return None
-            try:
-                df = pd.read_csv(file_path)
-                time_col = 'datetime' if 'datetime' in df.columns else 'time'
-                df[time_col] = pd.to_datetime(df[time_col])
-                
-                # Normalize Option CSV Time if it has timezone
-                if df[time_col].dt.tz is not None:
-                     df[time_col] = df[time_col].dt.tz_localize(None)
-
-                df.set_index(time_col, inplace=True)
-                
-                # Safety Sort (even if preprocessed, good to be safe)
-                if not df.index.is_monotonic_increasing:
-                    df.sort_index(inplace=True)
-                
-                # --- CALCULATE INDICATORS ---
-                df['EMA19_Close'] = df['close'].ewm(span=EMA_FAST, adjust=False).mean()
-                df['EMA50_High'] = df['high'].ewm(span=EMA_SLOW, adjust=False).mean()
-                df['EMA50_Low'] = df['low'].ewm(span=EMA_SLOW, adjust=False).mean()
-                
-                if self.position_active and scrip_code == self.active_scrip:
-                    self.active_option_df = df
-            except Exception as e: 
-                print(f"Error loading {scrip_code}: {e}")
-                return None
+            n = len(arr)
+            while cur + 1 < n and arr[cur + 1] <= ts_ns:
+                cur += 1
+        entry['cursor'] = cur
+        return cur
 
-        # 2. Get Data for Current Time
-        try:
-            ts = pd.Timestamp(local_dt) # Using the clean local time
-            
-            # asof lookup: finds the last available candle up to this time
-            idx = df.index.asof(ts)
-            if pd.isna(idx): return None
-            
-            # Sync Check: If option data is stale by > 15 mins, ignore
-            if (ts - idx).total_seconds() > 900: return None
+    def get_option_indicators(self, scrip_code):
+        """
+        Loads option data with indicators, and finds the bar matching the
+        current spot bar. Returns a (close, ema19, ema50_high, ema50_low)
+        tuple, or None.
+        """
+        # 1. Load Data (LRU-cached across scrips)
+        entry = self._load_option_arrays(scrip_code)
+        if entry is None:
+            return None
 
-            row = df.loc[idx]
-            return row
-        except: return None
+        # 2. Get Data for Current Time (last available candle up to this bar)
+        # Clean local time, pre-converted to int64 ns once at startup
+        ts_ns = self._time_ns[len(self.data) - 1]
+        cur = self._locate(entry, ts_ns)
+        if cur < 0: return None
+
+        # Sync Check: If option data is stale by > 15 mins, ignore
+        # (pure int64 compare, no Timedelta allocation)
+        if ts_ns - entry['ts_ns'][cur] > _STALE_NS: return None
+
+        return (entry['close'][cur], entry['ema19'][cur],
+                entry['ema50_high'][cur], entry['ema50_low'][cur])
 
     # -------------------------------------------------------------------------
     # HELPER: Logging
     # -------------------------------------------------------------------------
+    @staticmethod
+    def _new_ledger():
+        """ Fresh columnar (struct-of-arrays) ledger for one trade. """
+        return {'ts_ns': [], 'event': [], 'ticker_id': [], 'price': [],
+                'pnl': [], 'info': []}
+
+    def _ticker_id(self, scrip):
+        """ Small-int id for a scrip, so the ledger doesn't duplicate strings. """
+        tid = self._ticker_ids.get(scrip)
+        if tid is None:
+            tid = len(self._ticker_names)
+            self._ticker_ids[scrip] = tid
+            self._ticker_names.append(scrip)
+        return tid
+
     def log_trade_step(self, dt, event, price, pnl_val, info=""):
-        self.current_trade_ledger.append({
-            'Date': dt.date(), 'Time': dt.time(),
-            'Event': event, 'Ticker': self.active_scrip,
-            'Price': round(price, 2), 'PnL_INR': round(pnl_val, 2),
-            'Info': info
-        })
+        cols = self.current_trade_ledger
+        cols['ts_ns'].append(pd.Timestamp(dt).value)
+        cols['event'].append(event)
+        cols['ticker_id'].append(self._ticker_id(self.active_scrip))
+        # float() first: round() on a np.float32 stays float32, which can't
+        # hold 2-decimal values and prints as e.g. -549.5999755859375
+        cols['price'].append(round(float(price), 2))
+        cols['pnl'].append(round(float(pnl_val), 2))
+        cols['info'].append(info)
 
     # -------------------------------------------------------------------------
     # CORE STRATEGY LOGIC
     # -------------------------------------------------------------------------
     def next(self):
+        # Outside the precomputed entry window nothing can happen while
+        # flat, so skip all per-bar work up front.
+        if not self.position_active and not self.data.active_bar[0]:
+            return
+
         # 1. GET TRUE LOCAL TIME (The Fix)
         dt_local = self._get_current_local_time()
         current_date = dt_local.date()
         current_time = dt_local.time()
 
-        # 2. EXPIRY & ROLLOVER CHECK
-        exp_day = int(self.data.expiry_day[0])
-        exp_month = int(self.data.expiry_month[0])
-        exp_year = int(self.data.expiry_year[0])
-        expiry_date = datetime.date(exp_year, exp_month, exp_day)
-        
-        days_to_expiry = (expiry_date - current_date).days
-        is_rollover_period = days_to_expiry <= ROLLOVER_DAYS
+        # Prefetch both of today's option legs once per day, so the PE/CE
+        # checks below are cache hits (cursor advance + float compares, no
+        # filesystem work). Codes are still read per bar at entry time since
+        # the tracked strikes can roll intraday.
+        if self.current_date != current_date:
+            self.current_date = current_date
+            idx = len(self.data) - 1
+            self._load_option_arrays(self._scrip_pe_vocab[self._scrip_pe_codes[idx]])
+            self._load_option_arrays(self._scrip_ce_vocab[self._scrip_ce_codes[idx]])
+
+        # 2. EXPIRY & ROLLOVER CHECK (mask precomputed in __main__)
+        is_rollover_period = bool(self.data.is_rollover[0])
 
         # 3. MANAGE ACTIVE POSITION
         if self.position_active:
-            row = self.get_option_indicators(self.active_scrip, dt_local)
-            
-            if row is None: return 
+            row = self.get_option_indicators(self.active_scrip)
+
+            if row is None: return
 
-            curr_price = row['close']
+            curr_price, ema19, ema50_high, ema50_low = row
             pnl_val = (self.entry_price - curr_price) * self.p.qty # Short PnL
-            
+
             self.log_trade_step(dt_local, "HOLD", curr_price, pnl_val, "Monitoring")
 
             # A. Forced Exit: Rollover Period
@@ -196,7 +293,7 @@ class OptionSellingStrategy(bt.Strategy):
 
             # B. Strategy Exit 1: Reversal (Stop Loss)
             # EMA 19 Close > EMA 50 High
-            if row['EMA19_Close'] > row['EMA50_High']:
+            if ema19 > ema50_high:
                 self.close_trade("EMA_REVERSAL_SL", dt_local, curr_price)
                 return
 
@@ -211,35 +308,33 @@ class OptionSellingStrategy(bt.Strategy):
             # Global Filters
             if is_rollover_period: return 
             
-            # Time Window Check using integers
-            start_check = current_time >= datetime.time(ENTRY_START_HOUR, ENTRY_START_MIN)
-            end_check = current_time <= datetime.time(ENTRY_END_HOUR, ENTRY_END_MIN)
-            
-            if not (start_check and end_check):
+            # Time Window Check
+            if not (_T_ENTRY_START <= current_time <= _T_ENTRY_END):
                 return
 
-            # Access current Spot row for Scrip Codes
+            # Current bar's Scrip Codes (O(1) factorized lookup)
             idx = len(self.data) - 1
-            spot_row = self.data.p.dataname.iloc[idx]
-            
+
             # --- Check PE (Sell Put) ---
-            scrip_pe = spot_row['icici_scrip_code_pe']
-            row_pe = self.get_option_indicators(scrip_pe, dt_local)
+            scrip_pe = self._scrip_pe_vocab[self._scrip_pe_codes[idx]]
+            row_pe = self.get_option_indicators(scrip_pe)
             
             if row_pe is not None:
                 # Entry: EMA 19 < EMA 50 Low
-                if row_pe['EMA19_Close'] < row_pe['EMA50_Low']:
-                    self.open_trade("PE", scrip_pe, row_pe['close'], dt_local)
+                close_pe, ema19_pe, _, ema50_low_pe = row_pe
+                if ema19_pe < ema50_low_pe:
+                    self.open_trade("PE", scrip_pe, close_pe, dt_local)
                     return
 
             # --- Check CE (Sell Call) ---
-            scrip_ce = spot_row['icici_scrip_code_ce']
-            row_ce = self.get_option_indicators(scrip_ce, dt_local)
+            scrip_ce = self._scrip_ce_vocab[self._scrip_ce_codes[idx]]
+            row_ce = self.get_option_indicators(scrip_ce)
             
             if row_ce is not None:
                 # Entry: EMA 19 < EMA 50 Low
-                if row_ce['EMA19_Close'] < row_ce['EMA50_Low']:
-                    self.open_trade("CE", scrip_ce, row_ce['close'], dt_local)
+                close_ce, ema19_ce, _, ema50_low_ce = row_ce
+                if ema19_ce < ema50_low_ce:
+                    self.open_trade("CE", scrip_ce, close_ce, dt_local)
                     return
 
     # -------------------------------------------------------------------------
@@ -252,10 +347,8 @@ class OptionSellingStrategy(bt.Strategy):
         self.entry_price = price
         self.active_scrip = scrip
         self.entry_time = dt # Already clean local time
-        
-        self.active_option_df = None 
 
-        self.current_trade_ledger = []
+        self.current_trade_ledger = self._new_ledger()
         self.log_trade_step(dt, "SELL_ENTRY", price, 0, f"Signal {type_} | Short")
         # print(f"Trade Opened: {scrip} at {dt}")
 
@@ -271,35 +364,78 @@ class OptionSellingStrategy(bt.Strategy):
             'Side': 'SHORT',
             'SellDateTime': self.entry_time,
             'BuyDateTime': dt,
-            'SellPrice': round(self.entry_price, 2),
-            'BuyPrice': round(price, 2),
-            'PnL': round(pnl, 2),
+            'SellPrice': round(float(self.entry_price), 2),
+            'BuyPrice': round(float(price), 2),
+            'PnL': round(float(pnl), 2),
             'ExitReason': reason
         })
         
         # Save Details
         filename = f"Trade_{self.total_trades_count}_{self.active_scrip}_{self.entry_time.date()}.csv"
         filepath = os.path.join(DETAILS_FOLDER, filename)
-        pd.DataFrame(self.current_trade_ledger).to_csv(filepath, index=False)
-        
+        # The ledger is handed off as-is; open_trade rebinds a fresh one
+        # for the next trade, so the writer thread owns this one.
+        self._ledger_pool.submit(_write_ledger_csv, filepath,
+                                 self.current_trade_ledger, self._ticker_names)
+
         self.position_active = False
         self.pos_type = None
         self.active_scrip = ""
-        self.active_option_df = None
+
+    def stop(self):
+        """ Drains pending ledger writes before cerebro.run() returns. """
+        self._ledger_pool.shutdown(wait=True)
 
 # =============================================================================
 # 4. RUNNER
 # =============================================================================
+def load_spot():
+    """
+    Loads the spot dataset. Prefers the memory-mapped Arrow IPC (Feather v2)
+    cache — zero-copy, no text parsing — and writes it after the first CSV
+    parse so iterative tuning runs skip the parse entirely. The cache holds
+    naive local wall-clock time (shared with backtest_buying_momentum.py).
+    """
+    if os.path.exists(SPOT_FEATHER):
+        return feather.read_feather(SPOT_FEATHER, memory_map=True)
+    df = pd.read_csv(SPOT_FILE)
+    # Explicit ISO8601 format takes the C fast path (no per-row format
+    # inference); convert to local wall-clock time and drop the tz.
+    df['time'] = (pd.to_datetime(df['time'], format='ISO8601', utc=True)
+                  .dt.tz_convert('Asia/Kolkata').dt.tz_localize(None))
+    df.sort_values('time', inplace=True)
+    df.reset_index(drop=True, inplace=True)
+    # Quantize: float32 is ample for 0.05-tick prices, expiry parts fit
+    # int16, scrip codes become dictionary-encoded categories (int codes
+    # plus one string table) — roughly halves the frame's footprint
+    for col in ('open', 'high', 'low', 'close', 'volume'):
+        df[col] = df[col].astype('float32')
+    for col in ('expiry_day', 'expiry_month', 'expiry_year'):
+        df[col] = df[col].astype('int16')
+    for col in ('icici_scrip_code_ce', 'icici_scrip_code_pe'):
+        df[col] = df[col].astype('category')
+    feather.write_feather(df, SPOT_FEATHER)
+    return df
+
+
 if __name__ == '__main__':
     cerebro = bt.Cerebro()
-    
-    if os.path.exists(SPOT_FILE):
+
+    if os.path.exists(SPOT_FILE) or os.path.exists(SPOT_FEATHER):
         print("Loading Spot Data...")
-        df = pd.read_csv(SPOT_FILE)
-        # Process 'time' column here to ensure it's a timestamp object 
-        df['time'] = pd.to_datetime(df['time'])
-        df.sort_values('time', inplace=True)
-        
+        df = load_spot()
+
+        # Vectorize the per-bar expiry math once over the whole frame
+        df['expiry_date'] = pd.to_datetime(dict(
+            year=df['expiry_year'], month=df['expiry_month'], day=df['expiry_day']))
+        t = df['time'].dt.tz_localize(None) if df['time'].dt.tz is not None else df['time']
+        df['days_to_expiry'] = (df['expiry_date'] - t.dt.normalize()).dt.days
+        df['is_rollover'] = df['days_to_expiry'] <= ROLLOVER_DAYS
+
+        # Bars inside the entry window (local wall-clock time)
+        t_local = df['time'].dt.time
+        df['active_bar'] = (t_local >= _T_ENTRY_START) & (t_local <= _T_ENTRY_END)
+
         data = MidcapSpotData(dataname=df)
         cerebro.adddata(data)
         cerebro.addstrategy(OptionSellingStrategy)
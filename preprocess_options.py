@@ -0,0 +1,92 @@
+import os
+import sys
+import numpy as np
+import pandas as pd
+
+from _kernels import HAVE_NUMBA, ema_kernel
+
+# =============================================================================
+# 1. CONFIGURATION
+# =============================================================================
+# Raw per-scrip option CSV folders used by the two backtests
+OPTION_FOLDERS = [
+    'MIDCPNIFTY/ohlcv_options_MIDCPNIFTY_5m/',
+    'MIDCPNIFTY/preprocessed_ohlcv_options_MIDCPNIFTY_5m/',
+]
+
+# Indicator spans (must match backtest_crossselling.py)
+EMA_FAST = 19
+EMA_SLOW = 50
+
+# =============================================================================
+# 2. EMA WRAPPER
+# =============================================================================
+def ema(series, span):
+    """
+    EMA matching series.ewm(span=span, adjust=False).mean(). Uses the
+    precompiled single-pass kernel from _kernels when numba is available;
+    pandas' Cython path otherwise. The recurrence is carried in float64
+    regardless of the column dtype so quantization doesn't compound.
+    """
+    if HAVE_NUMBA and len(series) > 0:
+        return ema_kernel(series.to_numpy(dtype='float64'), 2.0 / (span + 1.0))
+    return series.ewm(span=span, adjust=False).mean().to_numpy()
+
+
+# =============================================================================
+# 3. CONVERSION
+# =============================================================================
+def preprocess_options(folder):
+    """
+    One-time conversion of every per-scrip option CSV in `folder` to Parquet.
+
+    Parses timestamps once, strips the timezone (keeping wall-clock time),
+    precomputes the EMA columns used by the selling strategy, sets the
+    datetime index and writes `<scrip>.parquet` next to each CSV. The
+    backtests then load typed, compressed columnar data instead of
+    re-parsing text and re-running ewm on every scrip switch.
+    """
+    count = 0
+    for fname in sorted(os.listdir(folder)):
+        if not fname.endswith('.csv'):
+            continue
+        df = pd.read_csv(os.path.join(folder, fname))
+        time_col = 'datetime' if 'datetime' in df.columns else 'time'
+        # Explicit ISO8601 format takes the C fast path; option files come
+        # both naive and tz-aware, so the tz is stripped separately below.
+        df[time_col] = pd.to_datetime(df[time_col], format='ISO8601')
+        if df[time_col].dt.tz is not None:
+            df[time_col] = df[time_col].dt.tz_localize(None)
+        df.set_index(time_col, inplace=True)
+        if not df.index.is_monotonic_increasing:
+            df.sort_index(inplace=True)
+
+        # float32 is ample for 0.05-tick option prices and halves the
+        # memory bandwidth of every downstream scan
+        for col in ('open', 'high', 'low', 'close', 'volume'):
+            if col in df.columns:
+                df[col] = df[col].astype('float32')
+
+        # Indicators used by OptionSellingStrategy (harmless extra columns
+        # for the buying strategy, which only reads 'close')
+        df['EMA19_Close'] = ema(df['close'], EMA_FAST).astype('float32')
+        df['EMA50_High'] = ema(df['high'], EMA_SLOW).astype('float32')
+        df['EMA50_Low'] = ema(df['low'], EMA_SLOW).astype('float32')
+
+        out_path = os.path.join(folder, fname[:-4] + '.parquet')
+        df.to_parquet(out_path, engine='pyarrow', compression='zstd')
+        count += 1
+    return count
+
+# =============================================================================
+# 4. MAIN EXECUTION
+# =============================================================================
+if __name__ == '__main__':
+    folders = sys.argv[1:] if len(sys.argv) > 1 else OPTION_FOLDERS
+    for folder in folders:
+        if not os.path.exists(folder):
+            print(f"Skipping missing folder: {folder}")
+            continue
+        print(f"Converting {folder} ...")
+        n = preprocess_options(folder)
+        print(f"  {n} files written")